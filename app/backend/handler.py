@@ -1,36 +1,59 @@
 import logging
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterable, Optional
 
 import folium
 import jinja2
+import orjson
 from folium.plugins import MarkerCluster
 
 ROOT_APP_FOLDER = Path(__file__).parent.parent
 STATIC_FOLDER = ROOT_APP_FOLDER / "static"
+_SCRIPTS_BODY = (STATIC_FOLDER / "scripts.js").read_text()
+_BODY_HTML = (STATIC_FOLDER / "body.html").read_text()
 
 OFFICE_COORDS = {"lat": 52.3152336, "lng": 4.9498692}
 OFFICE_ADDRESS = "Bijlmerdreef 106, 1102 CT Amsterdam, Netherlands"
 OFFICE_NAME = "ING Cedar Office"
 
+_MAP_SCRIPTS_TEMPLATE = jinja2.Template(
+    """
+    {% macro script(this, kwargs) %}
+        APARTMENTS_GEOJSON = {{ this.apartments_geojson }};
+        MAP_MARKERS_CLUSTER_NAME = '{{ this.marker_cluster_name }}';
+        MAP_NAME = '{{ this.map_name }}';
+        MAX_APARTMENT_PRICE = 3500;
+        {% raw %}"""
+    + _SCRIPTS_BODY
+    + """{% endraw %}
+    {% endmacro %}
+    {% macro html(this, kwargs) %}
+        {% raw %}"""
+    + _BODY_HTML
+    + """{% endraw %}
+    {% endmacro %}
+    """
+)
+
 
 def calculate_average_apartments_coords(
-    apartments: list[dict[str, Any]]
+    apartments: Iterable[dict[str, Any]]
 ) -> dict[str, float]:
     """
     Calculates the average coordinates of the apartments.
     """
-    latitudes = []
-    longitudes = []
+    sum_lat = sum_lng = 0.0
+    n_coordinates = 0
     for apartment in apartments:
         coordinates = apartment.get("coordinates")
         if not coordinates:
             continue
-        latitudes.append(coordinates["lat"])
-        longitudes.append(coordinates["lng"])
+        sum_lat += coordinates["lat"]
+        sum_lng += coordinates["lng"]
+        n_coordinates += 1
     return {
-        "lat": sum(latitudes) / len(latitudes),
-        "lng": sum(longitudes) / len(longitudes),
+        "lat": sum_lat / n_coordinates,
+        "lng": sum_lng / n_coordinates,
     }
 
 
@@ -47,118 +70,117 @@ def get_gmaps_directions_url(a_coords: dict[str, float], b_coords: dict[str, flo
     return f"https://www.google.com/maps/dir/{a_coords_str}/{b_coords_str}/data=!4m2!4m1!3e3"
 
 
+def get_apartment_feature(
+    idx: int, apartment: dict[str, Any], custom_markers: list[dict[str, Any]]
+) -> Optional[dict[str, Any]]:
+    """
+    Returns the apartment as a GeoJSON feature with the properties used
+    to build its marker popup, or None if it has no coordinates.
+    """
+    coordinates = apartment.get("coordinates")
+    if not coordinates:
+        get_logger().warning(
+            f"Apartment '{apartment['title']}' in idx {idx} has no coordinates, skipping..."
+        )
+        return None
+    n_rooms = apartment["n_rooms"]
+    # the popup HTML is built lazily in the browser from these properties
+    properties = {
+        "idx": idx,
+        "title": apartment["title"],
+        "url": apartment["url"],
+        "thumbnail": apartment["thumbnail"],
+        "address": apartment["address"],
+        "price": apartment["price"],
+        "price_period": apartment["price_period"],
+        "surface_area_amount": apartment["surface_area_amount"],
+        "surface_area_unit": (
+            "sqm"
+            if apartment["surface_area_unit"] == "m²"
+            else apartment["surface_area_unit"]
+        ),
+        "interior_type": apartment["interior_type"],
+        "n_rooms": int(float(n_rooms)) if n_rooms else None,
+        "time_to_office": apartment["time_to_office"],
+        "office_directions_url": apartment["office_directions_url"],
+        "time_to_center": apartment["time_to_center"],
+        "center_directions_url": apartment["center_directions_url"],
+        "custom_markers": [
+            {
+                "name": cm["name"],
+                "directions_url": apartment.get(f"cm_{cm_idx}_dir")
+                or get_gmaps_directions_url(
+                    coordinates, {"lat": cm["lat"], "lng": cm["lng"]}
+                ),
+            }
+            for cm_idx, cm in enumerate(custom_markers)
+        ],
+        "first_seen_at": (
+            apartment.get("first_seen_date")
+            or apartment["first_seen_at"].date().isoformat()
+        ),
+        "last_seen_at": (
+            apartment.get("last_seen_date")
+            or apartment["last_seen_at"].date().isoformat()
+        ),
+    }
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [coordinates["lng"], coordinates["lat"]],
+        },
+        "properties": properties,
+    }
+
+
 def generate_map_html(
-    apartments: list[dict[str, Any]], custom_markers: list[dict[str, Any]] = []
+    apartments: Iterable[dict[str, Any]],
+    custom_markers: list[dict[str, Any]] = [],
+    center: Optional[dict[str, float]] = None,
 ) -> str:
     """
     Generates a map representation of the apartments in the dataframe
     as an HTML string.
+    The map is centered on `center` if given, otherwise on the average
+    coordinates of the apartments.
+    The formatted first and last seen dates are read from the
+    `first_seen_date` and `last_seen_date` fields and the directions url
+    to the i-th custom marker from the `cm_{i}_dir` field if present,
+    otherwise they are computed here.
     """
     logger = get_logger()
     logger.info("Generating map...")
     office_coords = OFFICE_COORDS
-    if not apartments:
-        logger.warning("No apartments found, using office coordinates as center...")
-        avg_coords = office_coords
+    if center:
+        avg_coords = center
     else:
-        try:
-            avg_coords = calculate_average_apartments_coords(apartments)
-        except Exception as e:
-            logger.exception(
-                "Error while calculating average coordinates, using office coordinates as center..."
+        # the apartments are iterated twice when the center is computed from them
+        apartments = list(apartments)
+        if not apartments:
+            logger.warning(
+                "No apartments found, using office coordinates as center..."
             )
             avg_coords = office_coords
+        else:
+            try:
+                avg_coords = calculate_average_apartments_coords(apartments)
+            except Exception as e:
+                logger.exception(
+                    "Error while calculating average coordinates, using office coordinates as center..."
+                )
+                avg_coords = office_coords
     start_location = (avg_coords["lat"], avg_coords["lng"])
-    m = folium.Map(location=start_location, zoom_start=11)
+    m = folium.Map(location=start_location, zoom_start=11, prefer_canvas=True)
     # if the points are too close to each other, cluster them, create a cluster overlay with MarkerCluster
     marker_cluster = MarkerCluster().add_to(m)
-    # draw the markers and assign popup and hover texts
-    # add the markers the the cluster layers so that they are automatically clustered
-    markers = {}
-    for idx, apartment in enumerate(apartments):
-        coordinates = apartment.get("coordinates")
-        if not coordinates:
-            logger.warning(
-                f"Apartment '{apartment['title']}' in idx {idx} has no coordinates, skipping..."
-            )
-            continue
-        location = [coordinates["lat"], coordinates["lng"]]
-        name = apartment["title"]
-        open_new_tab_html = 'target="_blank" rel="noopener noreferrer"'
-        btn_style_part = (
-            "background-color: #4CAF50; border: none; color: white;"
-            "text-align: center; text-decoration: none; display: inline-block;"
-        )
-        btn_click_part = (
-            "onMouseOver=\"this.style.color='yellow'\" "
-            "onMouseOut=\"this.style.color='white'\""
-        )
-        custom_markers_html = ""
-        for cm in custom_markers:
-            custom_marker_coords = {
-                "lat": cm["lat"],
-                "lng": cm["lng"],
-            }
-            custom_marker_directions_url = get_gmaps_directions_url(
-                coordinates, custom_marker_coords
-            )
-            custom_marker_html = (
-                "<i class='fa-solid fa-user'></i> "
-                f"<a href='{custom_marker_directions_url}' {open_new_tab_html}>"
-                f"Directions to '{cm['name']}'</a><br>"
-            )
-            custom_markers_html += custom_marker_html
-        button_style = f'style="{btn_style_part}" {btn_click_part}'
-        surface_area_unit = (
-            "sqm"
-            if apartment["surface_area_unit"] == "m²"
-            else apartment["surface_area_unit"]
-        )
-        details = f"""
-        <div id="_apt_{idx}">
-        <a href={apartment['url']} {open_new_tab_html}><img src="{apartment["thumbnail"]}" width="150px" style="max-height: 125px; object-fit: cover"></a><br>
-        <a href={apartment['url']} {open_new_tab_html} style='font-weight: bold'>{apartment['title']}</a><br>
-        <small>{apartment['address']}</small><br>
-        <br>
-
-        <i class="fa-solid fa-sack-dollar"></i> Price: <b>{apartment["price"]} <i class="fa-solid fa-euro-sign fa-sm"></i> per {apartment["price_period"]}</b><br>
-        <i class="fa-solid fa-layer-group"></i> Surface: {apartment["surface_area_amount"]} {surface_area_unit}<br>
-        {'<i class="fa-solid fa-couch"></i> ' + apartment["interior_type"] + "<br>" if apartment["interior_type"] else ""}
-        {'<i class="fa-solid fa-door-closed"></i> ' + str(int(float(apartment["n_rooms"])))+" Rooms<br>" if apartment["n_rooms"] else ""}
-        <br>
-
-        <i class="fa-solid fa-train"></i> {apartment["time_to_office"]} from office*<br>
-        <a href="{apartment["office_directions_url"]}" {open_new_tab_html}>Directions to office</a><br>
-        <i class="fa-solid fa-train"></i>  {apartment["time_to_center"]} from city center*<br>
-        <a href="{apartment["center_directions_url"]}" {open_new_tab_html}>Directions to city center</a><br>
-        <br>
-
-        {custom_markers_html + '<br>' if custom_markers_html else ''}
-
-        <small>
-        * est. time by public transport<br>
-        First seen at: {apartment["first_seen_at"].date().isoformat()}<br>
-        Last seen at: {apartment["last_seen_at"].date().isoformat()}<br>
-        </small>
-
-        <div style="display: flex; gap: 10px; margin-top: 10px;">
-            <button {button_style} onclick="markVisited({idx})">Mark visited</button>
-            <button {button_style} onclick="markFavorite({idx})">Mark favorite</button>
-        </div>
-        <div style="display: flex; justify-content: center; margin-top: 5px; margin-bottom: 10px;">
-            <button style="{btn_style_part}; width: 100%;" {btn_click_part} onclick="setDefaultColor({idx})">Reset</button>
-        </div>
-        </div>
-        """
-        marker = folium.Marker(
-            location=location,
-            popup=details,
-            tooltip=name,
-            icon=folium.Icon(color="blue", icon="home"),
-        )
-        markers[idx] = marker.get_name()
-        marker.add_to(marker_cluster)
-        marker.icon.options["extraClasses"] += f" _apt_{idx}_marker_icon"
+    # collect the apartments data as GeoJSON features, the markers with their popup
+    # and hover texts are created and added to the cluster layer on the browser side
+    features = [
+        feature
+        for idx, apartment in enumerate(apartments)
+        if (feature := get_apartment_feature(idx, apartment, custom_markers))
+    ]
     # Add office marker
     office_location = (office_coords["lat"], office_coords["lng"])
     folium.Marker(
@@ -175,26 +197,12 @@ def generate_map_html(
                 popup=f"<b>{cm['name']}</b><br><small>Custom marker</small>",
                 icon=folium.Icon(color="cadetblue", icon="user", prefix="fa"),
             ).add_to(m)
-    # Add macro to change the color of the marker on click of a button
+    # Add macro that creates the apartment markers and changes their color on click of a button
     el = folium.MacroElement().add_to(m)
-    with open(STATIC_FOLDER / "scripts.js") as f:
-        scripts_body = f.read()
-    with open(STATIC_FOLDER / "body.html") as f:
-        body = f.read()
-    el._template = jinja2.Template(
-        f"""
-        {{% macro script(this, kwargs) %}}
-            ALL_MARKERS = { markers };
-            MAP_MARKERS_CLUSTER_NAME = '{ marker_cluster.get_name() }';
-            MAP_NAME = '{ m.get_name() }';
-            MAX_APARTMENT_PRICE = 3500;
-            {scripts_body}
-        {{% endmacro %}}
-        """
-        f"""
-        {{% macro html(this, kwargs) %}}
-            {body}
-        {{% endmacro %}}
-        """
-    )
+    el._template = _MAP_SCRIPTS_TEMPLATE
+    el.apartments_geojson = orjson.dumps(
+        {"type": "FeatureCollection", "features": features}
+    ).decode()
+    el.marker_cluster_name = marker_cluster.get_name()
+    el.map_name = m.get_name()
     return m.get_root().render()
@@ -1,16 +1,70 @@
+var APARTMENT_MARKERS = {};
+
+var OPEN_NEW_TAB = 'target="_blank" rel="noopener noreferrer"';
+var BTN_STYLE_PART = (
+    'background-color: #4CAF50; border: none; color: white;' +
+    'text-align: center; text-decoration: none; display: inline-block;'
+);
+var BTN_CLICK_PART = (
+    'onMouseOver="this.style.color=\'yellow\'" ' +
+    'onMouseOut="this.style.color=\'white\'"'
+);
+var BUTTON_STYLE = `style="${BTN_STYLE_PART}" ${BTN_CLICK_PART}`;
+
+function buildPopup(apt) {
+    var customMarkersHtml = apt.custom_markers.map(cm => (
+        `<i class='fa-solid fa-user'></i> ` +
+        `<a href='${cm.directions_url}' ${OPEN_NEW_TAB}>Directions to '${cm.name}'</a><br>`
+    )).join('');
+    return `
+        <div id="_apt_${apt.idx}">
+        <a href=${apt.url} ${OPEN_NEW_TAB}><img src="${apt.thumbnail}" width="150px" style="max-height: 125px; object-fit: cover"></a><br>
+        <a href=${apt.url} ${OPEN_NEW_TAB} style='font-weight: bold'>${apt.title}</a><br>
+        <small>${apt.address}</small><br>
+        <br>
+
+        <i class="fa-solid fa-sack-dollar"></i> Price: <b>${apt.price} <i class="fa-solid fa-euro-sign fa-sm"></i> per ${apt.price_period}</b><br>
+        <i class="fa-solid fa-layer-group"></i> Surface: ${apt.surface_area_amount} ${apt.surface_area_unit}<br>
+        ${apt.interior_type ? `<i class="fa-solid fa-couch"></i> ${apt.interior_type}<br>` : ''}
+        ${apt.n_rooms ? `<i class="fa-solid fa-door-closed"></i> ${apt.n_rooms} Rooms<br>` : ''}
+        <br>
+
+        <i class="fa-solid fa-train"></i> ${apt.time_to_office} from office*<br>
+        <a href="${apt.office_directions_url}" ${OPEN_NEW_TAB}>Directions to office</a><br>
+        <i class="fa-solid fa-train"></i>  ${apt.time_to_center} from city center*<br>
+        <a href="${apt.center_directions_url}" ${OPEN_NEW_TAB}>Directions to city center</a><br>
+        <br>
+
+        ${customMarkersHtml ? customMarkersHtml + '<br>' : ''}
+
+        <small>
+        * est. time by public transport<br>
+        First seen at: ${apt.first_seen_at}<br>
+        Last seen at: ${apt.last_seen_at}<br>
+        </small>
+
+        <div style="display: flex; gap: 10px; margin-top: 10px;">
+            <button ${BUTTON_STYLE} onclick="markVisited(${apt.idx})">Mark visited</button>
+            <button ${BUTTON_STYLE} onclick="markFavorite(${apt.idx})">Mark favorite</button>
+        </div>
+        <div style="display: flex; justify-content: center; margin-top: 5px; margin-bottom: 10px;">
+            <button style="${BTN_STYLE_PART}; width: 100%;" ${BTN_CLICK_PART} onclick="setDefaultColor(${apt.idx})">Reset</button>
+        </div>
+        </div>
+    `;
+}
+
 function markVisited(markerIdx) {
-    var markerName = ALL_MARKERS[markerIdx]
-    var marker = window[markerName];
-    marker.setIcon(new L.AwesomeMarkers.icon({ icon: 'home', markerColor: 'red' }));
+    var marker = APARTMENT_MARKERS[markerIdx];
+    marker.setStyle({ color: 'red', fillColor: 'red' });
     // Make sure it is in the cluster
     var cluster = window[MAP_MARKERS_CLUSTER_NAME];
     marker.addTo(cluster);
 }
 
 function markFavorite(markerIdx) {
-    var markerName = ALL_MARKERS[markerIdx]
-    var marker = window[markerName];
-    marker.setIcon(new L.AwesomeMarkers.icon({ icon: 'star', markerColor: 'purple' }));
+    var marker = APARTMENT_MARKERS[markerIdx];
+    marker.setStyle({ color: 'purple', fillColor: 'purple' });
     // Remove it from the cluster
     var cluster = window[MAP_MARKERS_CLUSTER_NAME];
     marker.removeFrom(cluster);
@@ -20,13 +74,32 @@ function markFavorite(markerIdx) {
 }
 
 function setDefaultColor(markerIdx) {
-    var markerName = ALL_MARKERS[markerIdx]
-    var marker = window[markerName];
-    marker.setIcon(new L.AwesomeMarkers.icon({ icon: 'home', markerColor: 'blue' }));
+    var marker = APARTMENT_MARKERS[markerIdx];
+    marker.setStyle({ color: 'blue', fillColor: 'blue' });
     // Make sure it is in the cluster
     var cluster = window[MAP_MARKERS_CLUSTER_NAME];
     marker.addTo(cluster);
 }
 
+// Create the apartment markers from the GeoJSON features and add them to the cluster
+var apartmentsLayer = L.geoJSON(APARTMENTS_GEOJSON, {
+    pointToLayer: function (feature, latlng) {
+        // Circle markers are drawn on the map canvas instead of as one DOM node each
+        return L.circleMarker(latlng, {
+            radius: 8,
+            color: 'blue',
+            fillColor: 'blue',
+            fillOpacity: 0.9
+        });
+    },
+    onEachFeature: function (feature, layer) {
+        // The popup content is only built when the popup is opened
+        layer.bindPopup(() => buildPopup(feature.properties), { maxWidth: '100%' });
+        layer.bindTooltip(feature.properties.title, { sticky: true });
+        APARTMENT_MARKERS[feature.properties.idx] = layer;
+    }
+});
+window[MAP_MARKERS_CLUSTER_NAME].addLayers(apartmentsLayer.getLayers());
+
 var map = window[MAP_NAME];
 map.addControl(new L.Control.Fullscreen());
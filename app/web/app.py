@@ -2,7 +2,7 @@ import io
 import os
 import sys
 from pathlib import Path
-from typing import Any, BinaryIO
+from typing import Any, BinaryIO, Callable, Optional, Union
 from urllib.parse import urlencode
 
 import boto3
@@ -26,35 +26,104 @@ st.set_page_config(
 )
 
 
+APARTMENTS_COLUMNS = [
+    "title",
+    "url",
+    "thumbnail",
+    "address",
+    "city",
+    "coordinates",
+    "price",
+    "price_period",
+    "surface_area_amount",
+    "surface_area_unit",
+    "interior_type",
+    "n_rooms",
+    "time_to_office",
+    "office_directions_url",
+    "time_to_center",
+    "center_directions_url",
+    "first_seen_at",
+    "last_seen_at",
+]
+CITY_INTERNAL_NAMES = {
+    "Amsterdam": "amsterdam",
+    "Den Haag": "den-haag",
+    "Haarlem": "haarlem",
+    "Leiden": "leiden",
+    "Rotterdam": "rotterdam",
+    "Utrecht": "utrecht",
+}
+POSSIBLE_INTERIOR_TYPES = [
+    "furnished",
+    "unfurnished",
+    "part-furnished",
+    "shell",
+]
+
+# Parsers of the supported query params, which are given as lists of values
+QUERY_PARAMS_PARSERS: dict[str, Callable[[list[str]], Any]] = {
+    "city": lambda value: value,
+    "interior_type": lambda value: value,
+    "max_price": lambda value: int(value[0]),
+    "min_surface": lambda value: int(value[0]),
+    "max_days_online": lambda value: int(value[0]),
+    "custom_marker_lat": lambda value: float(value[0]),
+    "custom_marker_lng": lambda value: float(value[0]),
+    "custom_marker_name": lambda value: str(value[0]),
+}
+
+
 def get_query_params() -> dict[str, Any]:
     query_params = st.experimental_get_query_params()
     return query_params
 
 
-def retrieve_apartments_data() -> BinaryIO:
+def retrieve_apartments_data() -> Union[str, BinaryIO]:
     """
-    Retrieves the apartments data from local or s3
-    and returns it as a file-like object.
+    Retrieves the apartments data from local or s3.
+    Local and parquet datasets are returned as their path so that they can be
+    scanned lazily, csv datasets in s3 are downloaded and returned as a
+    file-like object.
     """
     apartments_path = os.getenv("APARTMENTS_DATASET_URI")
     if not apartments_path:
         raise ValueError(
             "The path to the apartments dataset is not set. Please set the 'APARTMENTS_DATASET_URI' environment variable."
         )
+    apartments_data_format = os.getenv("APARTMENTS_DATASET_FORMAT", "parquet")
+    if not apartments_path.startswith("s3://") or apartments_data_format == "parquet":
+        # Local path or parquet file in s3, which polars reads with range requests
+        return apartments_path
     fb = io.BytesIO()
-    if apartments_path.startswith("s3://"):
-        s3_bucket, s3_key = apartments_path.replace("s3://", "").split("/", 1)
-        s3 = boto3.client("s3")
-        s3.download_fileobj(s3_bucket, s3_key, fb)
-        fb.seek(0)
-    else:
-        # Assume local path
-        with open(apartments_path, "rb") as f:
-            fb.write(f.read())
-        fb.seek(0)
+    s3_bucket, s3_key = apartments_path.replace("s3://", "").split("/", 1)
+    s3 = boto3.client("s3")
+    s3.download_fileobj(s3_bucket, s3_key, fb)
+    fb.seek(0)
     return fb
 
 
+def get_s3_storage_options() -> dict[str, str]:
+    """
+    Returns the polars storage options to read from s3, with the credentials
+    and region resolved by boto3 (environment, profiles, SSO, instance roles).
+    The 'AWS_REGION' environment variable overrides the resolved region.
+    """
+    session = boto3.Session()
+    storage_options = {}
+    credentials = session.get_credentials()
+    if credentials:
+        frozen_credentials = credentials.get_frozen_credentials()
+        storage_options["aws_access_key_id"] = frozen_credentials.access_key
+        storage_options["aws_secret_access_key"] = frozen_credentials.secret_key
+        if frozen_credentials.token:
+            storage_options["aws_session_token"] = frozen_credentials.token
+    region = os.getenv("AWS_REGION") or session.region_name
+    if region:
+        storage_options["aws_region"] = region
+    return storage_options
+
+
 def export_filters_url(filters_query_params: dict[str, Any]) -> str:
     """
     Exports the selected filters as a url.
@@ -70,35 +139,33 @@ def export_filters_url(filters_query_params: dict[str, Any]) -> str:
 def parse_query_params(query_params: dict[str, Any]) -> dict[str, Any]:
     """
     Parses the query params from the given dictionary.
+    Unknown query params are ignored.
     """
-    array_params = ["city", "interior_type"]
-    int_params = ["max_price", "min_surface", "max_days_online"]
-    float_params = ["custom_marker_lat", "custom_marker_lng"]
-    str_params = ["custom_marker_name"]
     parsed_query_params = {}
     for key, value in query_params.items():
-        p_value = value[0] if key not in array_params else value
-        if key in array_params:
-            parsed_query_params[key] = p_value
-        if key in int_params:
-            parsed_query_params[key] = int(p_value)
-        if key in float_params:
-            parsed_query_params[key] = float(p_value)
-        if key in str_params:
-            parsed_query_params[key] = str(p_value)
+        parser = QUERY_PARAMS_PARSERS.get(key)
+        if parser:
+            parsed_query_params[key] = parser(value)
     return parsed_query_params
 
 
-def parse_apartments_dataset(apartments_fb: BinaryIO) -> pl.DataFrame:
+def parse_apartments_dataset(apartments_source: Union[str, BinaryIO]) -> pl.LazyFrame:
     """
-    Parses the apartments dataset from the given file-like object
-    and returns it as a polars dataframe.
+    Parses the apartments dataset from the given path or file-like object
+    and returns it as a polars lazy frame.
     """
     apartments_data_format = os.getenv("APARTMENTS_DATASET_FORMAT", "parquet")
     if apartments_data_format == "parquet":
-        return pl.read_parquet(apartments_fb)
+        if not isinstance(apartments_source, str):
+            return pl.read_parquet(apartments_source).lazy()
+        storage_options = None
+        if apartments_source.startswith("s3://"):
+            storage_options = get_s3_storage_options()
+        return pl.scan_parquet(apartments_source, storage_options=storage_options)
     elif apartments_data_format == "csv":
-        return pl.read_csv(apartments_fb)
+        if isinstance(apartments_source, str):
+            return pl.scan_csv(apartments_source)
+        return pl.read_csv(apartments_source).lazy()
     else:
         raise ValueError(
             f"Invalid apartments data format '{apartments_data_format}'. Valid are 'parquet' or 'csv'."
@@ -118,16 +185,123 @@ def get_apartments_max_limit() -> int:
     return int(max_apartments_value)
 
 
-@st.cache_data
+@st.cache_resource
 def load_apartments() -> pl.DataFrame:
     """
-    Loads the apartments dataset from local or s3.
+    Loads the apartments dataset from local or s3
+    with only the columns used by the app.
+    The dataset is read once per process. Only the column projection is
+    pushed down to the reader, the filters change on every rerun and are
+    applied to the cached dataframe by `filter_apartments`.
     """
-    apartments_fb = retrieve_apartments_data()
-    apartments = parse_apartments_dataset(apartments_fb)
+    apartments_source = retrieve_apartments_data()
+    apartments = (
+        parse_apartments_dataset(apartments_source)
+        .select(APARTMENTS_COLUMNS)
+        .with_columns(
+            interior_type=(
+                pl.when(pl.col("interior_type").is_null())
+                .then(pl.lit("?"))
+                .otherwise(pl.col("interior_type"))
+            ),
+            days_online=(
+                pl.col("last_seen_at") - pl.col("first_seen_at")
+            ).dt.total_days(),
+        )
+        .with_columns(
+            city_internal=(
+                pl.col("city")
+                .str.to_lowercase()
+                .str.replace_all(" ", "-", literal=True)
+                .cast(pl.Categorical)
+            ),
+            interior_type_lc=(
+                pl.col("interior_type").str.to_lowercase().cast(pl.Categorical)
+            ),
+        )
+        .collect()
+    )
     return apartments
 
 
+def filter_apartments(
+    apartments: pl.DataFrame,
+    cities: list[str],
+    max_price: int,
+    min_surface: int,
+    interior_types: list[str],
+    max_days_online: int,
+    limit: int,
+) -> pl.DataFrame:
+    """
+    Filters the apartments and returns at most `limit` of them.
+    """
+    cities_internal_names = [CITY_INTERNAL_NAMES[city] for city in cities]
+    interior_types_lc = list(map(str.lower, interior_types))
+    return (
+        apartments.lazy()
+        .filter(
+            (pl.col("city_internal").is_in(cities_internal_names))
+            & (pl.col("price") <= max_price)
+            & (pl.col("surface_area_amount") >= min_surface)
+            & (
+                pl.col("interior_type_lc").is_in(interior_types_lc)
+                | ~pl.col("interior_type_lc").is_in(POSSIBLE_INTERIOR_TYPES)
+                | (pl.col("interior_type_lc") == "")
+            )
+            & (pl.col("days_online").cast(pl.Int64) <= max_days_online)
+        )
+        .limit(limit)
+        .collect()
+    )
+
+
+def get_apartments_center(apartments: pl.DataFrame) -> Optional[dict[str, float]]:
+    """
+    Returns the average coordinates of the apartments,
+    or None if none of them has coordinates.
+    """
+    center = apartments.select(
+        lat=pl.col("coordinates").struct.field("lat").mean(),
+        lng=pl.col("coordinates").struct.field("lng").mean(),
+    ).row(0, named=True)
+    if center["lat"] is None or center["lng"] is None:
+        return None
+    return center
+
+
+@st.cache_data(max_entries=32)
+def render_map_html(
+    _apartments: pl.DataFrame,
+    apartments_hash: int,
+    custom_markers: list[dict[str, Any]],
+) -> str:
+    """
+    Renders the map of the given apartments as an HTML string.
+    The dataframe itself is not hashed by streamlit,
+    `apartments_hash` is used as its cache key instead.
+    """
+    apartments_rows = _apartments.with_columns(
+        first_seen_date=pl.col("first_seen_at").dt.strftime("%Y-%m-%d"),
+        last_seen_date=pl.col("last_seen_at").dt.strftime("%Y-%m-%d"),
+        *[
+            pl.format(
+                "https://www.google.com/maps/dir/{},{}/{},{}/data=!4m2!4m1!3e3",
+                pl.col("coordinates").struct.field("lat"),
+                pl.col("coordinates").struct.field("lng"),
+                pl.lit(cm["lat"]),
+                pl.lit(cm["lng"]),
+            ).alias(f"cm_{idx}_dir")
+            for idx, cm in enumerate(custom_markers)
+        ],
+    ).iter_rows(named=True)
+    return generate_map_html(
+        apartments_rows,
+        custom_markers=custom_markers,
+        center=get_apartments_center(_apartments),
+    )
+
+
 def update_params_on_change():
     """
     Updates the query params when the filters are changed.
@@ -149,17 +323,7 @@ def update_params_on_change():
 
 
 st.title("Apartments in The Netherlands")
-raw_apartments = load_apartments()
-apartments = raw_apartments.with_columns(
-    interior_type=(
-        pl.when(raw_apartments["interior_type"].is_null())
-        .then(pl.lit("?"))
-        .otherwise(raw_apartments["interior_type"])
-    ),
-    days_online=(
-        raw_apartments["last_seen_at"] - raw_apartments["first_seen_at"]
-    ).dt.total_days(),
-)
+apartments = load_apartments()
 
 OFFICE_NAME = os.getenv("APARTMENTS_MAP_OFFICE_NAME", "the Office")
 with st.expander("ℹ️ About", expanded=False):
@@ -192,14 +356,7 @@ with st.sidebar:
     # Warn that adding filters will remove the custom markers
     with st.form("filters_form", border=False):
         # City Filter
-        possible_cities = [
-            "Amsterdam",
-            "Den Haag",
-            "Haarlem",
-            "Leiden",
-            "Rotterdam",
-            "Utrecht",
-        ]
+        possible_cities = list(CITY_INTERNAL_NAMES)
         selected_cities = st.multiselect(
             "City",
             possible_cities,
@@ -225,13 +382,7 @@ with st.sidebar:
             key="min_surface",
         )
         # Interior type filter
-        possible_interior_types = [
-            "furnished",
-            "unfurnished",
-            "part-furnished",
-            "shell",
-        ]
-        possible_interior_types_title = list(map(str.title, possible_interior_types))
+        possible_interior_types_title = list(map(str.title, POSSIBLE_INTERIOR_TYPES))
         selected_interior_types = st.multiselect(
             "Interior type",
             possible_interior_types_title,
@@ -283,31 +434,17 @@ with st.sidebar:
             st.error("Ups! You forgot to fill one of the fields.", icon="🙈")
 
 # Filter apartments based on the filters
-filtered_apartments = apartments
-selected_cities_internal_names = list(
-    map(
-        lambda city: city.lower().replace(" ", "-"),
-        selected_cities,
-    )
-)
-# Filter apartments
 max_limit = get_apartments_max_limit()
-filtered_apartments = filtered_apartments.filter(
-    (apartments["city"].str.to_lowercase().is_in(selected_cities_internal_names))
-    & (apartments["price"] <= max_price)
-    & (apartments["surface_area_amount"] >= min_surface)
-    & (
-        (
-            apartments["interior_type"]
-            .str.to_lowercase()
-            .is_in(list(map(str.lower, selected_interior_types)))
-        )
-        | ~apartments["interior_type"].str.to_lowercase().is_in(possible_interior_types)
-        | (apartments["interior_type"] == "")
-    )
-    & (apartments["days_online"].cast(pl.Int64) <= max_days_online)
-).limit(max_limit)
-apartments_to_show = filtered_apartments.to_dicts()
+filtered_apartments = filter_apartments(
+    apartments,
+    cities=selected_cities,
+    max_price=max_price,
+    min_surface=min_surface,
+    interior_types=selected_interior_types,
+    max_days_online=max_days_online,
+    limit=max_limit,
+)
+n_apartments_to_show = filtered_apartments.height
 custom_marker = (
     {
         "name": custom_marker_name,
@@ -317,20 +454,19 @@ custom_marker = (
     if all([custom_marker_name, custom_marker_lat, custom_marker_lng])
     else None
 )
-map_html = generate_map_html(
-    apartments_to_show,
+map_html = render_map_html(
+    filtered_apartments,
+    apartments_hash=filtered_apartments.hash_rows().sum(),
     custom_markers=[custom_marker] if custom_marker else [],
 )
-# Remove strange characters from the html
-map_html = map_html.encode("ascii", "ignore").decode("ascii")
 # Add iframe:
 components.html(map_html, width=None, height=600)
 st.text(
-    f"Showing {len(apartments_to_show)} apartments (max {max_limit})."
-    if apartments_to_show
+    f"Showing {n_apartments_to_show} apartments (max {max_limit})."
+    if n_apartments_to_show
     else ":red[No apartments found]"
 )
-if len(apartments_to_show) == max_limit:
+if n_apartments_to_show == max_limit:
     st.write(
         f":red[Showing the maximum number of apartments ({max_limit}). Try to apply some filters to see more relevant apartments for you.]"
     )